@@ -1,6 +1,6 @@
 import argparse
 import pickle
-import math
+import sys
 import numpy as np
 import tensorflow as tf
 
@@ -28,28 +28,40 @@ def loadLFW():
     # Original dataset here: http://conradsanderson.id.au/lfwcrop/
     return np.load('lfw.npy')
 
-def zeros(shape):
-
-    return tf.Variable(tf.zeros(shape))
-
-def normal(shape, std_dev):
+"""
+Random batch from the training set, sampled on the device where the training
+set is stored
+generator:  Random number generator used for sampling the indices
+train_x:    Training set, as a tensor
+batch_size: Number of training examples taken in the batch
+"""
+def sampleBatch(generator, train_x, batch_size):
 
-    return tf.Variable(tf.random.normal(shape, stddev = std_dev))
+    batch_indices = generator.uniform([batch_size], maxval=tf.shape(train_x)[0],
+                                      dtype=tf.int32)
 
+    return tf.gather(train_x, batch_indices)
 
 class ReLULayer(tf.keras.layers.Layer):
     """
     Initialize layer object with the given input and output dimensions
     input_dim:  Dimension of inputs to the layer
     output_dim: Dimension of outputs of the layer
+    dtype:      Precision policy of the layer, the global policy if not given
     """
 
-    def __init__(self, input_dim, output_dim):
-        super(ReLULayer, self).__init__()
+    def __init__(self, input_dim, output_dim, dtype=None):
+        super(ReLULayer, self).__init__(dtype=dtype)
 
-        # initialize weights and biases for the layer
-        self.W = normal([input_dim, output_dim], 1.0 / math.sqrt(input_dim))
-        self.b = zeros([output_dim])
+        # fully connected layer with the bias and the activation applied in the
+        # same layer, initialized for the 'ReLU' activation
+        self.dense = tf.keras.layers.Dense(output_dim, activation='relu',
+                         kernel_initializer=tf.keras.initializers.HeNormal(),
+                         dtype=dtype)
+
+        # create the weights now rather than on the first call, which may be
+        # inside a traced training step
+        self.dense.build((None, input_dim))
 
     """
     Forward propagation in the layer
@@ -57,36 +69,57 @@ class ReLULayer(tf.keras.layers.Layer):
     """
 
     def call(self, x):
-        return tf.nn.relu(tf.matmul(x, self.W) + self.b)
+        return self.dense(x)
 
 
 class SigmoidLayer(tf.keras.layers.Layer):
     """
     Initialize layer object with the given input, output dimensions and dropout
     retention probabilities
-    input_dim:    Dimension of inputs to the layer
-    output_dim:   Dimension of outputs of the layer
-    dropout_prob: Fraction of dropout retention in the layer
+    input_dim:      Dimension of inputs to the layer
+    output_dim:     Dimension of outputs of the layer
+    retention_prob: Fraction of dropout retention in the layer
+    dtype:          Precision policy of the layer, the global policy if not
+                    given
     """
 
-    def __init__(self, input_dim, output_dim, dropout_prob=0.0):
-        super(SigmoidLayer, self).__init__()
+    def __init__(self, input_dim, output_dim, retention_prob=1.0, dtype=None):
+        super(SigmoidLayer, self).__init__(dtype=dtype)
+
+        # fraction of the inputs to drop, as dropout in TF2 takes the drop rate
+        # rather than the retention probability
+        self.rate = 1.0 - retention_prob
 
-        # initialize weights and biases for the layer
-        self.W = normal([input_dim, output_dim], 1.0 / math.sqrt(input_dim))
-        self.b = zeros([output_dim])
+        # dropout on the inputs of the layer
+        self.dropout = tf.keras.layers.Dropout(self.rate, dtype=dtype)
 
-        # store the dropout retention probability for later use
-        self.dropout_prob = dropout_prob
+        # fully connected layer, the sigmoid is applied separately so that the
+        # logits are available to the cross entropy costs
+        self.dense = tf.keras.layers.Dense(output_dim,
+                         kernel_initializer=tf.keras.initializers.GlorotUniform(),
+                         dtype=dtype)
+
+        # create the weights now rather than on the first call, which may be
+        # inside a traced training step
+        self.dense.build((None, input_dim))
+
+    """
+    Logits of the layer, before the sigmoid is applied
+    x:        Input to the layer
+    training: Whether dropout is applied to the input
+    """
+
+    def preActivation(self, x, training=None):
+        return self.dense(self.dropout(x, training=training))
 
     """
     Forward propagation in the layer
-    x: Input to the layer
+    x:        Input to the layer
+    training: Whether dropout is applied to the input
     """
 
-    def call(self, x):
-        return tf.sigmoid(tf.matmul(tf.nn.dropout(x, self.dropout_prob),
-                                    self.W) + self.b)
+    def call(self, x, training=None):
+        return tf.sigmoid(self.preActivation(x, training=training))
 
 
 class DataSpaceNetwork(tf.keras.Model):
@@ -113,8 +146,23 @@ class DataSpaceNetwork(tf.keras.Model):
                                               dimensions[dim_index + 1]))
 
         # last layer is 'Sigmoid' as we need the outputs to be in [0, 1]
+        # it is kept in float32 under mixed precision, so the generated images
+        # and the MMD measure on them are computed in full precision
         self.layers_list.append(SigmoidLayer(dimensions[dim_index + 1],
-                                             dimensions[dim_index + 2]))
+                                             dimensions[dim_index + 2],
+                                             dtype='float32'))
+
+        # random number generator for the training batches and the uniform
+        # samples, so that they are drawn on the device inside the training step
+        self.generator = tf.random.Generator.from_non_deterministic_state()
+
+    """
+    Batch of samples from the uniform, which is the input to the network
+    """
+
+    def sampleUniform(self):
+        return self.generator.uniform((self.batch_size, self.dimensions[0]),
+                                      -1.0, 1.0)
 
     """
     Forward propagation of the network
@@ -126,27 +174,14 @@ class DataSpaceNetwork(tf.keras.Model):
         # initialize the first 'hidden' layer to the input
         h = x
 
-        # for all the layers propagate the activation forward
-        # all layers have the 'forward()' method
-        for dim_index in range(len(self.dimensions) - 1):
-            h = self.layers[dim_index](h)
+        # for all the layers propagate the activation forward, the loop is over
+        # a Python list so it is unrolled into a flat chain of layers when
+        # traced
+        for layer in self.layers_list:
+            h = layer(h)
 
         return h
 
-    """
-    Scale column for the MMD measure
-    num_gen:  Number of samples to be generated in one pass, 'N' in the paper
-    num_orig: Number of samples taken from dataset in one pass, 'M' in the paper
-    """
-
-    def makeScaleMatrix(self, num_gen, num_orig):
-
-        # first 'N' entries have '1/N', next 'M' entries have '-1/M'
-        s1 = tf.constant(1.0 / num_gen, shape=[num_gen, 1])
-        s2 = -tf.constant(1.0 / num_orig, shape=[num_orig, 1])
-
-        return tf.concat([s1, s2], 0)
-
     """
     Calculates cost of the network, which is square root of the mixture of 'K'
     RBF kernels
@@ -160,52 +195,66 @@ class DataSpaceNetwork(tf.keras.Model):
         # generate images from the provided uniform samples
         gen_x = self.call(samples)
 
-        # concatenation of the generated images and images from the dataset
-        # first 'N' rows are the generated ones, next 'M' are from the data
-        X = tf.concat([gen_x, x], 0)
-
-        # dot product between all combinations of rows in 'X'
-        XX = tf.matmul(X, tf.transpose(X))
-
-        # dot product of rows with themselves
-        X2 = tf.math.reduce_sum(X * X, 1, keepdims=True)
-
-        # exponent entries of the RBF kernel (without the sigma) for each
-        # combination of the rows in 'X'
-        # -0.5 * (x^Tx - 2*x^Ty + y^Ty)
-        exponent = XX - 0.5 * X2 - 0.5 * tf.transpose(X2)
-
-        # scaling constants for each of the rows in 'X'
-        s = self.makeScaleMatrix(self.batch_size, self.batch_size)
-
-        # scaling factors of each of the kernel values, corresponding to the
-        # exponent values
-        S = tf.matmul(s, tf.transpose(s))
-
-        loss = 0
-
-        # for each bandwidth parameter, compute the MMD value and add them all
-        for i in range(len(sigma)):
-            # kernel values for each combination of the rows in 'X'
-            kernel_val = tf.exp(1.0 / sigma[i] * exponent)
-            loss += tf.reduce_sum(S * kernel_val)
+        # dot products between all combinations of rows within the generated
+        # samples, within the dataset samples, and between the two
+        # the transposes are done inside the matrix multiplications
+        GG = tf.matmul(gen_x, gen_x, transpose_b=True)
+        XX = tf.matmul(x, x, transpose_b=True)
+        GX = tf.matmul(gen_x, x, transpose_b=True)
+
+        # dot product of rows with themselves, which are the diagonals of the
+        # above; they are broadcast against the blocks as column and row
+        # vectors, which only changes their shape rather than transposing them
+        G2 = tf.linalg.diag_part(GG)
+        X2 = tf.linalg.diag_part(XX)
+
+        # squared distances between each combination of the rows in the three
+        # blocks, x^Tx - 2*x^Ty + y^Ty, clipped at zero against rounding errors
+        dists_gg = tf.maximum(G2[:, None] - 2.0 * GG + G2[None, :], 0.0)
+        dists_xx = tf.maximum(X2[:, None] - 2.0 * XX + X2[None, :], 0.0)
+        dists_gx = tf.maximum(G2[:, None] - 2.0 * GX + X2[None, :], 0.0)
+
+        # scales of the squared distances in the exponent of the RBF kernel,
+        # -0.5 / sigma, shaped to broadcast over the distances
+        dist_scale = tf.reshape(tf.constant(-0.5 / np.array(sigma),
+                                            dtype=tf.float32), [-1, 1, 1])
+
+        # kernel values summed over all the bandwidth parameters and all the
+        # entries of each block
+        kernel_gg = tf.reduce_sum(tf.exp(dist_scale * dists_gg[None, :, :]))
+        kernel_xx = tf.reduce_sum(tf.exp(dist_scale * dists_xx[None, :, :]))
+        kernel_gx = tf.reduce_sum(tf.exp(dist_scale * dists_gx[None, :, :]))
+
+        # 'N' generated samples and 'M' samples from the dataset in one pass
+        num_gen = self.batch_size
+        num_orig = self.batch_size
+
+        # MMD^2 = mean(k(g, g')) + mean(k(x, x')) - 2 * mean(k(g, x))
+        loss = (kernel_gg / (num_gen * num_gen) +
+                kernel_xx / (num_orig * num_orig) -
+                2.0 * kernel_gx / (num_gen * num_orig))
 
         return tf.sqrt(loss)
 
 class Autoencoder(tf.keras.Model):
 
     """
-    Initialize autoencoder with the given dimensions and dropout fractions for
-    each of the layers
+    Initialize autoencoder with the given dimensions, dropout fractions for
+    each of the layers and the batch size
     dimensions: Dimensions of the autoencoder from the input till the innermost
                 hidden layer
     dropout:    Retention fractions for dropout in the hidden layers
+    batch_size: Number of training examples taken in the batch
     """
-    def __init__(self, dimensions, dropout):
+    def __init__(self, dimensions, dropout, batch_size):
         super(Autoencoder, self).__init__()
 
-        # store 'dimensions' for later use
+        # store 'dimensions' and 'batch_size' for later use
         self.dimensions = dimensions
+        self.batch_size = batch_size
+
+        # random number generator for sampling the training batches
+        self.generator = tf.random.Generator.from_non_deterministic_state()
 
         # store the layers as a list
         self.layers_list = []
@@ -216,36 +265,77 @@ class Autoencoder(tf.keras.Model):
                                             dimensions[dim_index+1],
                                             dropout[dim_index]))
 
-        # add the decoder layers
+        # add the decoder layers, the reconstruction layer is kept in float32
+        # under mixed precision
         for dim_index in range(len(dimensions)-1)[::-1]:
             self.layers_list.append(SigmoidLayer(dimensions[dim_index+1],
-                                            dimensions[dim_index]))
+                                            dimensions[dim_index],
+                                            dtype='float32' if dim_index == 0
+                                                  else None))
 
     """
-    Reconstruction cost for one layer
+    Logits of the reconstruction of the input images by the stacked
+    autoencoders, before the sigmoid of the last layer
+    x:        Input batch of images
+    training: Whether dropout is applied in the encoder layers
+    """
+    def reconstructionLogits(self, x, training=None):
+
+        # initialize hidden representation to the input
+        h = x
+
+        # forward propagation over all the layers but the last one, passing on
+        # the training mode to their dropout
+        for layer in self.layers_list[:-1]:
+            h = layer(h, training=training)
+
+        return self.layers_list[-1].preActivation(h, training=training)
+
+    """
+    Reconstruction of the input images by the stacked autoencoders
+    x:        Input batch of images
+    training: Whether dropout is applied in the encoder layers
+    """
+    def call(self, x, training=None):
+
+        return tf.sigmoid(self.reconstructionLogits(x, training=training))
+
+    """
+    Input representation to a layer, given by forward propagating on the
+    previously trained layers, which are frozen while training this layer
     x:           Input batch of images
-    layer_index: Index of the layer to train
+    layer_index: Index of the layer to get the input representation of
     """
-    def layerCost(self, x, layer_index):
+    def layerInput(self, x, layer_index):
 
         # initialize the input representation to the passed images
         input_rep = x
 
-        # get the input representation to this layer by forward propagating on
-        # the previously trained layers
-        for layer in range(layer_index):
-            input_rep = self.layers[layer](input_rep)
+        for layer in self.layers_list[:layer_index]:
+            input_rep = layer(input_rep)
+
+        # stop the gradient as the previous layers are not trained any more
+        return tf.stop_gradient(tf.cast(input_rep, tf.float32))
+
+    """
+    Reconstruction cost for one layer
+    input_rep:   Input representation to the layer, see 'layerInput()'
+    layer_index: Index of the layer to train
+    """
+    def layerCost(self, input_rep, layer_index):
 
         # get the hidden representation for the layer
-        h = self.layers[layer_index](input_rep)
+        h = self.layers_list[layer_index](input_rep, training=True)
 
-        # reconstruct using the hidden representation
-        rec = self.layers[len(self.layers) - 1 - layer_index](h)
+        # logits of the reconstruction using the hidden representation
+        rec_layer = self.layers_list[len(self.layers_list) - 1 - layer_index]
+        logits = rec_layer.preActivation(h, training=True)
 
         # return the cross entropy loss between the input representation and the
-        # reconstruction
-        return -tf.reduce_sum(input_rep * tf.math.log(rec) + (1 - input_rep) *
-                              tf.math.log(1 - rec))
+        # reconstruction, computed in float32 under mixed precision
+        return tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(
+                                 labels=input_rep,
+                                 logits=tf.cast(logits, tf.float32)))
 
     """
     Reconstruction cost using the network of stacked autoencoders
@@ -253,16 +343,17 @@ class Autoencoder(tf.keras.Model):
     """
     def finetuneCost(self, x):
 
-        # initialize hidden representation to the input
-        h = x
-
-        # forward propagation over all the layers
-        for layer in range(len(self.layers)):
-            h = self.layers[layer](h)
+        # logits of the reconstruction, with dropout applied in the encoder
+        # layers; the activations of all the layers are kept for the backward
+        # pass, as the encoder layers apply dropout and cannot be recomputed,
+        # and the dropout-free inner decoder is a single layer whose output the
+        # reconstruction layer keeps anyway
+        logits = self.reconstructionLogits(x, training=True)
 
         # return the cross entropy between the input images and the
         # reconstruction
-        return -tf.reduce_sum(x * tf.math.log(h) + (1 - x) * tf.math.log(1 - h))
+        return tf.reduce_sum(tf.nn.sigmoid_cross_entropy_with_logits(
+                                 labels=x, logits=logits))
 
 class CodeSpaceNetwork(tf.keras.Model):
 
@@ -294,9 +385,21 @@ class CodeSpaceNetwork(tf.keras.Model):
       decoder_input_size = auto_encoder_dims[-1]
 
       # the last layer is 'Sigmoid' as all the layers of the autoencoder are
-      # 'Sigmoid'
+      # 'Sigmoid', it is kept in float32 under mixed precision so the MMD
+      # measure on the codes is computed in full precision
       self.layers_list.append(SigmoidLayer(dimensions[dim_index+1],
-                                      decoder_input_size))
+                                      decoder_input_size, dtype = 'float32'))
+
+      # random number generator for the training batches and the uniform
+      # samples, so that they are drawn on the device inside the training step
+      self.generator = tf.random.Generator.from_non_deterministic_state()
+
+    """
+    Batch of samples from the uniform, which is the input to the network
+    """
+    def sampleUniform(self):
+        return self.generator.uniform((self.batch_size, self.dimensions[0]),
+                                      -1.0, 1.0)
 
     """
     Forward propagation of the network
@@ -307,10 +410,11 @@ class CodeSpaceNetwork(tf.keras.Model):
         # initialize the first 'hidden' layer to the input
         h = x
 
-        # for all the layers propagate the activation forward
-        # all layers have the 'forward()' method
-        for dim_index in range(len(self.dimensions)):
-            h = self.layers[dim_index](h)
+        # for all the layers propagate the activation forward, the loop is over
+        # a Python list so it is unrolled into a flat chain of layers when
+        # traced
+        for layer in self.layers_list:
+            h = layer(h)
 
         return h
 
@@ -322,17 +426,14 @@ class CodeSpaceNetwork(tf.keras.Model):
     def generate(self, x, auto_encoder):
 
         # generate codes from the uniform samples
-        h = x
-        for dim_index in range(len(self.dimensions)):
-            h = self.layers[dim_index](h)
+        h = self.call(x)
 
         # start layer of the decoder of the autoencoder
         layer_index = len(auto_encoder.dimensions) - 1
 
         # generate images using the above generated codes
-        while layer_index < len(auto_encoder.layers):
-            h = auto_encoder.layers[layer_index](h)
-            layer_index += 1
+        for layer in auto_encoder.layers_list[layer_index:]:
+            h = layer(h)
 
         return h
 
@@ -345,30 +446,17 @@ class CodeSpaceNetwork(tf.keras.Model):
         # initialize the 'hidden' layer to the input
         h = x
 
-        # start layer of the encoder
-        layer_index = 0
+        # last layer of the encoder
+        num_layers = len(auto_encoder.layers_list) // 2
 
         # propagate forward till the innermost layer
-        while layer_index < len(auto_encoder.layers)/2:
-            h = auto_encoder.layers[layer_index](h)
-            layer_index += 1
+        for layer in auto_encoder.layers_list[:num_layers]:
+            h = layer(h)
 
         # stop the gradient as we don't want to train the autoencoder while
-        # training the network
-        return tf.stop_gradient(h)
-
-    """
-    Scale column for the MMD measure
-    num_gen:  Number of samples to be generated in one pass, 'N' in the paper
-    num_orig: Number of samples taken from dataset in one pass, 'M' in the paper
-    """
-    def makeScaleMatrix(self, num_gen, num_orig):
-
-        # first 'N' entries have '1/N', next 'M' entries have '-1/M'
-        s1 =  tf.constant(1.0 / num_gen, shape = [num_gen, 1])
-        s2 = -tf.constant(1.0 / num_orig, shape = [num_orig, 1])
-
-        return tf.concat([s1, s2], 0)
+        # training the network, the codes are compared in float32 under mixed
+        # precision
+        return tf.stop_gradient(tf.cast(h, tf.float32))
 
     """
     Calculates cost of the network, which is square root of the mixture of 'K'
@@ -385,38 +473,145 @@ class CodeSpaceNetwork(tf.keras.Model):
         # generate autoencoder codes from the dataset batch
         encode_x = self.encode(x, auto_encoder)
 
-        # concatenation of the generated codes and the autoencoder codes for
-        # batch of images from the dataset
-        X = tf.concat([gen_x, encode_x], 0)
+        # dot products between all combinations of rows within the generated
+        # samples, within the dataset samples, and between the two
+        # the transposes are done inside the matrix multiplications
+        GG = tf.matmul(gen_x, gen_x, transpose_b = True)
+        XX = tf.matmul(encode_x, encode_x, transpose_b = True)
+        GX = tf.matmul(gen_x, encode_x, transpose_b = True)
+
+        # dot product of rows with themselves, which are the diagonals of the
+        # above; they are broadcast against the blocks as column and row
+        # vectors, which only changes their shape rather than transposing them
+        G2 = tf.linalg.diag_part(GG)
+        X2 = tf.linalg.diag_part(XX)
+
+        # squared distances between each combination of the rows in the three
+        # blocks, x^Tx - 2*x^Ty + y^Ty, clipped at zero against rounding errors
+        dists_gg = tf.maximum(G2[:, None] - 2.0 * GG + G2[None, :], 0.0)
+        dists_xx = tf.maximum(X2[:, None] - 2.0 * XX + X2[None, :], 0.0)
+        dists_gx = tf.maximum(G2[:, None] - 2.0 * GX + X2[None, :], 0.0)
+
+        # scales of the squared distances in the exponent of the RBF kernel,
+        # -0.5 / sigma, shaped to broadcast over the distances
+        dist_scale = tf.reshape(tf.constant(-0.5 / np.array(sigma),
+                                            dtype = tf.float32), [-1, 1, 1])
+
+        # kernel values summed over all the bandwidth parameters and all the
+        # entries of each block
+        kernel_gg = tf.reduce_sum(tf.exp(dist_scale * dists_gg[None, :, :]))
+        kernel_xx = tf.reduce_sum(tf.exp(dist_scale * dists_xx[None, :, :]))
+        kernel_gx = tf.reduce_sum(tf.exp(dist_scale * dists_gx[None, :, :]))
+
+        # 'N' generated samples and 'M' samples from the dataset in one pass
+        num_gen = self.batch_size
+        num_orig = self.batch_size
+
+        # MMD^2 = mean(k(g, g')) + mean(k(x, x')) - 2 * mean(k(g, x))
+        loss = (kernel_gg / (num_gen * num_gen) +
+                kernel_xx / (num_orig * num_orig) -
+                2.0 * kernel_gx / (num_gen * num_orig))
 
-        # dot product between all combinations of rows in 'X'
-        XX = tf.matmul(X, tf.transpose(X))
+        return tf.sqrt(loss)
 
-        # dot product of rows with themselves
-        X2 = tf.math.reduce_sum(X * X, 1, keepdims = True)
+@tf.function(jit_compile=True)
+def trainStep(network, optimizer, train_x, *loss_args):
+    """
+    Single optimization step of a moment matching network, traced once into a
+    graph and reused for all the batches. The step is compiled with XLA, so the
+    kernel computations of the MMD loss and its gradient are fused
+    network:   DataSpaceNetwork or CodeSpaceNetwork object to be trained
+    optimizer: Optimizer used to apply the gradients
+    train_x:   Training set, as a tensor
+    loss_args: Extra arguments passed on to 'computeLoss()'
+    """
 
-        # exponent entries of the RBF kernel (without the sigma) for each
-        # combination of the rows in 'X'
-        # -0.5 * (x^Tx - 2*x^Ty + y^Ty)
-        exponent = XX - 0.5 * X2 - 0.5 * tf.transpose(X2)
+    # random batch from the training set, batch of uniform samples, both drawn
+    # on the device
+    batch_x = sampleBatch(network.generator, train_x, network.batch_size)
+    batch_uniform = network.sampleUniform()
 
-        # scaling constants for each of the rows in 'X'
-        s = self.makeScaleMatrix(self.batch_size, self.batch_size)
+    with tf.GradientTape() as tape:
+        loss = network.computeLoss(batch_x, batch_uniform, *loss_args)
 
-        # scaling factors of each of the kernel values, corresponding to the
-        # exponent values
-        S = tf.matmul(s, tf.transpose(s))
+    # optimize the network
+    variables = network.trainable_variables
+    grads = tape.gradient(loss, variables)
+    optimizer.apply_gradients(list(zip(grads, variables)))
 
-        loss = 0
+    return loss
 
-        # for each bandwidth parameter, compute the MMD value and add them all
-        for i in range(len(sigma)):
+@tf.function(jit_compile=False)
+def layerTrainStep(auto_encoder, optimizer, train_rep, layer_index):
+    """
+    Single greedy optimization step of one layer of the autoencoder
+    auto_encoder: Autoencoder object to be trained
+    optimizer:    Optimizer used to apply the gradients
+    train_rep:    Input representations of the training set to the layer
+    layer_index:  Index of the layer to train
+    """
 
-            # kernel values for each combination of the rows in 'X'
-            kernel_val = tf.exp(1.0 / sigma[i] * exponent)
-            loss += tf.reduce_sum(S * kernel_val)
+    # random batch of the input representations
+    batch_rep = sampleBatch(auto_encoder.generator, train_rep,
+                            auto_encoder.batch_size)
 
-        return tf.sqrt(loss)
+    with tf.GradientTape() as tape:
+        loss = auto_encoder.layerCost(batch_rep, layer_index)
+
+    # optimize the layer
+    variables = auto_encoder.layers_list[layer_index].trainable_variables
+    grads = tape.gradient(loss, variables)
+    optimizer.apply_gradients(list(zip(grads, variables)))
+
+    return loss
+
+@tf.function(jit_compile=False)
+def finetuneTrainStep(auto_encoder, optimizer, train_x):
+    """
+    Single finetuning step of the whole stacked autoencoder
+    auto_encoder: Autoencoder object to be trained
+    optimizer:    Optimizer used to apply the gradients
+    train_x:      Training set, as a tensor
+    """
+
+    # random batch from the training set
+    batch_x = sampleBatch(auto_encoder.generator, train_x,
+                          auto_encoder.batch_size)
+
+    with tf.GradientTape() as tape:
+        loss = auto_encoder.finetuneCost(batch_x)
+
+    # optimize the autoencoder
+    variables = auto_encoder.trainable_variables
+    grads = tape.gradient(loss, variables)
+    optimizer.apply_gradients(list(zip(grads, variables)))
+
+    return loss
+
+@tf.function
+def trainLoop(train_step, num_iterations, iteration_break, cost_name,
+              *step_args):
+    """
+    Take the given number of training steps, with the whole loop run as a
+    single graph instead of one call from Python per step
+    train_step:      Training step function, one of the above
+    num_iterations:  Number of batches to train on
+    iteration_break: Frequency of printing out the cost
+    cost_name:       Name of the cost in the printed out lines
+    step_args:       Arguments passed on to 'train_step()'
+    The loop is retraced for every training stage, so all the variables the
+    stage uses (layer weights and optimizer slots) must already exist when it is
+    called
+    """
+
+    for i in tf.range(num_iterations):
+
+        loss = train_step(*step_args)
+
+        # print out the cost after every 'iteration_break' iterations
+        if i % iteration_break == 0:
+            tf.print(cost_name + ' at iteration ', i + 1, ': ', loss, sep='',
+                     output_stream=sys.stdout)
 
 def generateFigure(samples, num_rows, num_cols, image_side, file_name):
 
@@ -429,20 +624,15 @@ def generateFigure(samples, num_rows, num_cols, image_side, file_name):
     file_name:  File name for the generated figure to be saved
     """
 
-    # initialize the figure object
-    figure, axes = plt.subplots(nrows = num_rows, ncols = num_cols)
-
-    index = 0
-    # take the first 'num_rows * num_cols' samples from the provided batch
-    for axis in axes.flat:
-        image = axis.imshow(tf.reshape(samples[index, :], [image_side, image_side]),
-                            cmap = plt.cm.gray, interpolation = 'nearest')
-        axis.set_frame_on(False)
-        axis.set_axis_off()
-        index += 1
+    # take the first 'num_rows * num_cols' samples from the provided batch and
+    # tile them into a single image, row by row
+    images = np.asarray(samples)[:num_rows * num_cols]
+    grid = images.reshape(num_rows, num_cols, image_side, image_side)
+    grid = grid.transpose(0, 2, 1, 3).reshape(num_rows * image_side,
+                                              num_cols * image_side)
 
     # save the figure
-    figure.savefig(file_name)
+    plt.imsave(file_name, grid, cmap = plt.cm.gray, vmin = 0.0, vmax = 1.0)
 
 
 def trainDataSpaceNetwork(dataset):
@@ -474,40 +664,31 @@ def trainDataSpaceNetwork(dataset):
     # get a DataSpaceNetwork object
     data_space_network = DataSpaceNetwork(data_space_dims, batch_size)
 
+    # create the optimizer slots eagerly, before 'trainStep()' is traced
     optimizer = tf.keras.optimizers.Adam()
+    optimizer.build(data_space_network.trainable_variables)
 
     # number of batches to train the model on, and frequency of printing out the
     # cost
     num_iterations = 40001
     iteration_break = 1000
 
-    for i in range(num_iterations):
-
-        # sample a random batch from the training set
-        batch_indices = np.random.randint(num_examples, size=batch_size)
-        batch_x = train_x[batch_indices]
-        batch_uniform = np.random.uniform(low=-1.0, high=1.0,
-                                          size=(batch_size, data_space_dims[0]))
-
-        # print out the cost after every 'iteration_break' iterations
-        if i % iteration_break == 0:
-            curr_cost = data_space_network.computeLoss(batch_x, batch_uniform)
-            print('Cost at iteration ' + str(i + 1) + ': ' + str(curr_cost))
-
-        with tf.GradientTape() as tape:
-            loss = data_space_network.computeLoss(batch_x, batch_uniform)
+    # training set as one contiguous float32 array of flattened images, stored
+    # on the device once; batches are sampled from it inside the training step
+    train_x = tf.constant(np.ascontiguousarray(
+                  train_x[:num_examples].reshape(num_examples, input_dim),
+                  dtype=np.float32))
 
-        # optimize the network
-        grads = tape.gradient(loss, data_space_network.trainable_weights)
-        optimizer.apply_gradients(zip(grads, data_space_network.trainable_weights))
+    # optimize the network
+    trainLoop(trainStep, num_iterations, iteration_break, 'Cost',
+              data_space_network, optimizer, train_x)
 
     # parameters for figure generation
     num_rows = 10;
     num_cols = 10
 
     # generate samples from the trained network
-    batch_uniform = np.random.uniform(low=-1.0, high=1.0,
-                                      size=(batch_size, data_space_dims[0]))
+    batch_uniform = data_space_network.sampleUniform()
     gen_samples = data_space_network(batch_uniform)
 
     # generate figure of generated samples
@@ -546,11 +727,15 @@ def trainCodeSpaceNetwork(dataset):
     code_space_dims = [10, 64, 256, 256, input_dim]
 
     # get Autoencoder and CodeSpaceNetwork objects
-    auto_encoder = Autoencoder(auto_encoder_dims, [0.8, 0.5])
+    auto_encoder = Autoencoder(auto_encoder_dims, [0.8, 0.5], enc_batch_size)
     code_space_network = CodeSpaceNetwork(code_space_dims, auto_encoder_dims,
                                           batch_size)
 
-    optimizer = tf.keras.optimizers.Adam()
+    # training set as one contiguous float32 array of flattened images, stored
+    # on the device once; batches are sampled from it inside the training steps
+    train_x = tf.constant(np.ascontiguousarray(
+                  train_x[:num_examples].reshape(num_examples, input_dim),
+                  dtype=np.float32))
 
     # number of batches to train the each layer on, and frequency of printing
     # out the cost
@@ -560,79 +745,54 @@ def trainCodeSpaceNetwork(dataset):
     # greedily optimize each layer
     for layer_index in range(len(auto_encoder_dims) - 1):
 
-        for i in range(num_iterations):
-
-            # sample a random batch from the training set
-            batch_indices = np.random.randint(num_examples,
-                                              size=enc_batch_size)
-            batch_x = train_x[batch_indices, :]
-
-            with tf.GradientTape() as tape:
-                loss = auto_encoder.layerCost(batch_x, layer_index)
-
-            # print out the cost after every 'iteration_break' iterations
-            if i % iteration_break == 0:
-                print('Autoencoder' + str(layer_index + 1) + \
-                      ' cost at iteration ' + str(i + 1) + ': ' + str(loss))
+        # input representation of the training set to this layer, computed
+        # once as the previously trained layers are frozen
+        train_rep = tf.concat([auto_encoder.layerInput(
+                                   train_x[start:start + batch_size],
+                                   layer_index)
+                               for start in range(0, num_examples, batch_size)],
+                              0)
+
+        # each training stage gets its own optimizer, with the slots for its
+        # own set of variables created eagerly, as the step functions are
+        # retraced for every stage and cannot create variables then
+        optimizer = tf.keras.optimizers.Adam()
+        optimizer.build(
+            auto_encoder.layers_list[layer_index].trainable_variables)
 
-            # optimize the layer
-            grads = tape.gradient(loss, auto_encoder.layers[layer_index].trainable_weights)
-            optimizer.apply_gradients(zip(grads, auto_encoder.layers[layer_index].trainable_weights))
+        # optimize the layer
+        trainLoop(layerTrainStep, num_iterations, iteration_break,
+                  'Autoencoder' + str(layer_index + 1) + ' cost',
+                  auto_encoder, optimizer, train_rep, layer_index)
 
     # number of batches to finetune the autoencoder on
     num_iterations = 4001
 
-    # finetune the autoencoder
-    for i in range(num_iterations):
-
-        # sample a random batch from the training set and finetune the
-        # autoencoder
-        batch_indices = np.random.randint(num_examples, size=enc_batch_size)
-        batch_x = train_x[batch_indices, :]
-
-        with tf.GradientTape() as tape:
-            loss = auto_encoder.finetuneCost(batch_x)
-
-        # print out the cost after every 'iteration_break' iterations
-        if i % iteration_break == 0:
-            print('Stacked autoencoder cost at iteration ' + str(i + 1) + ': ' + \
-                  str(loss))
+    optimizer = tf.keras.optimizers.Adam()
+    optimizer.build(auto_encoder.trainable_variables)
 
-        # optimize the layer
-        grads = tape.gradient(loss, auto_encoder.trainable_weights)
-        optimizer.apply_gradients(zip(grads, auto_encoder.trainable_weights))
+    # finetune the autoencoder
+    trainLoop(finetuneTrainStep, num_iterations, iteration_break,
+              'Stacked autoencoder cost', auto_encoder, optimizer, train_x)
 
     # number of batches to train the moment matching network on, and frequency
     # of printing out the cost
     num_iterations = 40001
     iteration_break = 1000
 
-    for i in range(num_iterations):
-
-        # sample a random batch from the training set, batch of uniform samples
-        batch_indices = np.random.randint(num_examples, size=batch_size)
-        batch_x = train_x[batch_indices, :]
-        batch_uniform = np.random.uniform(low=-1.0, high=1.0,
-                                          size=(batch_size, code_space_dims[0]))
-
-        with tf.GradientTape() as tape:
-            loss = code_space_network.computeLoss(batch_x, batch_uniform, auto_encoder)
-
-        # print out the cost after every 'iteration_break' iterations
-        if i % iteration_break == 0:
-            print('Cost at iteration ' + str(i + 1) + ': ' + str(loss))
+    optimizer = tf.keras.optimizers.Adam()
+    optimizer.build(code_space_network.trainable_variables)
 
-        # optimize the moment matching network
-        grads = tape.gradient(loss, code_space_network.trainable_weights)
-        optimizer.apply_gradients(zip(grads, code_space_network.trainable_weights))
+    # optimize the moment matching network
+    trainLoop(trainStep, num_iterations, iteration_break, 'Cost',
+              code_space_network, optimizer, train_x, auto_encoder)
 
     # parameters for figure generation
     num_rows = 10;
     num_cols = 10
 
     # generate samples from the trained network
-    batch_uniform = np.random.uniform(low=-1.0, high=1.0,
-                                      size=(batch_size, code_space_dims[0]))
+    batch_uniform = code_space_network.sampleUniform()
     gen_samples = code_space_network.generate(batch_uniform, auto_encoder)
 
     # generate figure of generated samples
@@ -642,8 +802,15 @@ def trainCodeSpaceNetwork(dataset):
 parser = argparse.ArgumentParser(description = 'Train GMMN')
 parser.add_argument('-d', '--dataset', choices = ['mnist', 'lfw'])
 parser.add_argument('-n', '--network', choices = ['data_space', 'code_space'])
+parser.add_argument('-m', '--mixed_precision', action = 'store_true',
+                    help = 'compute the hidden layers in bfloat16')
 args = parser.parse_args()
 
+# the hidden layers compute in bfloat16 while the weights, the output layers
+# and the losses stay in float32
+if args.mixed_precision:
+    tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
 if args.network == 'data_space':
     trainDataSpaceNetwork(args.dataset)
 elif args.network == 'code_space':